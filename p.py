@@ -1,33 +1,96 @@
 import tweepy
+import aiohttp
+import asyncio
 import pandas as pd
+import numpy as np
 import time
+import random
 import boto3
-import os
+import io
+import csv
+import gzip
+import heapq
 import logging
+from tweepy.asynchronous import AsyncClient
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from airflow.models import Variable
 from datetime import timedelta
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def run_twitter_etl():
-    def check_rate_limits(client):
-        try:
-            status = client.get_rate_limit_status()
-            user_tweets_endpoint = status['resources']['users']['/users/:id/tweets']
-            logger.info(f"User tweets endpoint: {user_tweets_endpoint['remaining']} requests remaining, resets at {user_tweets_endpoint['reset']}")
-            return user_tweets_endpoint['remaining']
-        except Exception as e:
-            logger.error(f"Error checking rate limits: {str(e)}")
-            return 0
+# Maps newlines/tabs to spaces when cleaning tweet text
+_WS = str.maketrans({'\n': ' ', '\r': ' ', '\t': ' '})
+
+# Columns collected per tweet by get_user_tweets
+_TWEET_COLUMNS = ['id', 'created_at', 'text', 'likes', 'retweets', 'tweet_length']
+
+# Output columns, shared by the pandas and csv.writer paths
+_CSV_HEADERS = ['id', 'created_at', 'text', 'likes', 'retweets', 'tweet_length', 'created_date', 'created_hour']
+
+# Below this many rows the CSV is written with csv.writer instead of pandas
+_PANDAS_MIN_ROWS = 1024
+
+# Up to this many rows JSONL output is sent with a single put_object
+_PUT_OBJECT_MAX_ROWS = 1024
+
+# Write buffer in front of the gzip stream
+_WRITE_BUFFER_SIZE = 1 << 20
+
+# Backoff caps: Twitter's rate limit window for 429s, a short cap for 5xx
+_RATE_LIMIT_MAX_WAIT = 900
+_SERVER_ERROR_BASE_WAIT = 1.0
+_SERVER_ERROR_MAX_WAIT = 30
+
+# Minimum spacing between paginated requests for one user (Twitter asks for at most 1 req/s)
+_MIN_REQUEST_INTERVAL = 1.0
+
+# S3 client is reused across DAG runs on the same worker
+_S3 = None
+
+def _s3():
+    global _S3
+    if _S3 is None:
+        _S3 = boto3.client(
+            's3',
+            config=Config(max_pool_connections=32, retries={'mode': 'adaptive', 'max_attempts': 5})
+        )
+    return _S3
+
+def _fast_to_csv(df, out):
+    # Row formatter for the fixed _CSV_HEADERS schema; text is quoted only when needed, as csv.writer does
+    fmt = '%s,%s,%s,%d,%d,%d,%s,%d\n'
+    text = df['text']
+    quoted = '"' + text.str.replace('"', '""') + '"'
+    df = df[_CSV_HEADERS].assign(text=text.where(~text.str.contains('[,"\r\n]'), quoted))
+    write = out.write
+    write((','.join(_CSV_HEADERS) + '\n').encode('utf-8'))
+    for row in df.itertuples(index=False, name=None):
+        write((fmt % row).encode('utf-8'))
 
-    def upload_to_s3(local_file, bucket_name, s3_file):
-        s3 = boto3.client('s3')
+def run_twitter_etl(output_format='csv'):
+    # Rate limit state from the headers of the most recent Twitter response
+    rate_limit = {}
+
+    async def record_rate_limit(session, trace_config_ctx, params):
+        headers = params.response.headers
+        remaining = headers.get('x-rate-limit-remaining')
+        if remaining is not None:
+            rate_limit['remaining'] = int(remaining)
+            rate_limit['reset'] = headers.get('x-rate-limit-reset')
+
+    def upload_to_s3(fileobj, bucket_name, s3_file, extra_args=None):
+        s3 = _s3()
         try:
-            if not os.path.exists(local_file):
-                raise FileNotFoundError(f"Local file {local_file} does not exist.")
-            s3.upload_file(local_file, bucket_name, s3_file)
-            logger.info(f"Uploaded {local_file} to s3://{bucket_name}/{s3_file}")
+            s3.upload_fileobj(
+                fileobj,
+                bucket_name,
+                s3_file,
+                ExtraArgs=extra_args,
+                Config=TransferConfig(multipart_threshold=8 * 1024 * 1024, max_concurrency=8, use_threads=True)
+            )
+            logger.info(f"Uploaded to s3://{bucket_name}/{s3_file}")
         except boto3.exceptions.S3UploadFailedError as e:
             logger.error(f"S3 upload failed: {str(e)}")
             raise
@@ -35,80 +98,241 @@ def run_twitter_etl():
             logger.error(f"Failed to upload to S3: {str(e)}")
             raise
 
-    def get_user_tweets(client, username, count=5, max_retries=3, initial_wait=60):
+    def put_to_s3(body, bucket_name, s3_file, content_type):
+        s3 = _s3()
         try:
-            user = client.get_user(username=username)
-            if not user.data:
-                logger.warning(f"User {username} not found.")
-                return []
+            s3.put_object(Bucket=bucket_name, Key=s3_file, Body=body, ContentType=content_type)
+            logger.info(f"Uploaded to s3://{bucket_name}/{s3_file}")
+        except Exception as e:
+            logger.error(f"Failed to upload to S3: {str(e)}")
+            raise
+
+    def backoff_wait(e, retries, base_wait, max_wait):
+        wait_time = min(max_wait, base_wait * (2 ** (retries - 1)) * (1 + random.uniform(0, 0.5)))
+        retry_after = e.response.headers.get('retry-after') if e.response is not None else None
+        if retry_after:
+            try:
+                wait_time = max(wait_time, float(retry_after))
+            except ValueError:
+                pass
+        return wait_time
 
-            tweets = []
+    async def get_user_tweets(client, user_id, count=5, max_retries=3, initial_wait=60):
+        try:
+            ids, created_at, text, likes, retweets, text_lens = [], [], [], [], [], []
+            add_id, add_created_at, add_text = ids.append, created_at.append, text.append
+            add_likes, add_retweets, add_text_len = likes.append, retweets.append, text_lens.append
             next_token = None
             remaining_count = count
-            retries = 0
+            rate_limit_retries = 0
+            server_retries = 0
+            last_request = None
 
-            while remaining_count > 0 and retries < max_retries:
+            while remaining_count > 0:
                 try:
+                    if last_request is not None:
+                        await asyncio.sleep(max(0, _MIN_REQUEST_INTERVAL - (time.monotonic() - last_request)))
+                    last_request = time.monotonic()
+
                     batch_size = min(remaining_count, 100)
-                    response = client.get_users_tweets(
-                        id=user.data.id,
+                    response = await client.get_users_tweets(
+                        id=user_id,
                         max_results=batch_size,
                         tweet_fields=['created_at', 'public_metrics'],
                         exclude=['replies', 'retweets'],
                         pagination_token=next_token
                     )
+                    if 'remaining' in rate_limit:
+                        logger.info(f"User tweets endpoint: {rate_limit['remaining']} requests remaining, resets at {rate_limit['reset']}")
 
-                    if not response.data:
+                    data = response.data
+                    if not data:
                         logger.info("No tweets found.")
                         break
 
-                    tweets.extend([{
-                        'id': tweet.id,
-                        'created_at': tweet.created_at,
-                        'text': tweet.text,
-                        'likes': tweet.public_metrics['like_count'],
-                        'retweets': tweet.public_metrics['retweet_count']
-                    } for tweet in response.data])
-
-                    remaining_count -= len(response.data)
-                    next_token = response.meta.get('next_token')
-                    if not next_token or len(tweets) >= count:
+                    for tweet in data:
+                        pm = tweet.public_metrics
+                        add_id(tweet.id)
+                        add_created_at(tweet.created_at)
+                        cleaned = tweet.text.translate(_WS).strip()
+                        add_text(cleaned)
+                        add_text_len(len(cleaned))
+                        add_likes(pm['like_count'])
+                        add_retweets(pm['retweet_count'])
+
+                    remaining_count -= len(data)
+                    next_token = (response.meta or {}).get('next_token')
+                    if not next_token or len(ids) >= count:
+                        break
+
+                    if 'remaining' in rate_limit and rate_limit['remaining'] <= 1:
+                        logger.warning("Rate limit nearly exhausted. Stopping pagination.")
                         break
 
-                except tweepy.TooManyRequests:
-                    retries += 1
-                    wait_time = initial_wait * (2 ** (retries - 1))
-                    logger.warning(f"Rate limit hit. Retry {retries}/{max_retries}. Waiting {wait_time}s...")
-                    time.sleep(wait_time)
+                except tweepy.TooManyRequests as e:
+                    rate_limit_retries += 1
+                    if rate_limit_retries >= max_retries:
+                        logger.error(f"Max rate limit retries ({max_retries}) reached. No more attempts.")
+                        return {}
+                    wait_time = backoff_wait(e, rate_limit_retries, initial_wait, _RATE_LIMIT_MAX_WAIT)
+                    logger.warning(f"Rate limit hit. Retry {rate_limit_retries}/{max_retries}. Waiting {wait_time:.1f}s...")
+                    await asyncio.sleep(wait_time)
+                    continue
+                except tweepy.TwitterServerError as e:
+                    server_retries += 1
+                    if server_retries >= max_retries:
+                        logger.error(f"Max server error retries ({max_retries}) reached. No more attempts.")
+                        return {}
+                    wait_time = backoff_wait(e, server_retries, _SERVER_ERROR_BASE_WAIT, _SERVER_ERROR_MAX_WAIT)
+                    logger.warning(f"Twitter server error ({e.response.status}). Retry {server_retries}/{max_retries}. Waiting {wait_time:.1f}s...")
+                    await asyncio.sleep(wait_time)
                     continue
                 except tweepy.TweepyException as e:
                     logger.error(f"Twitter API error: {str(e)}")
-                    return []
+                    return {}
 
-            if retries >= max_retries:
-                logger.error(f"Max retries ({max_retries}) reached. No more attempts.")
-                return []
+            if not ids:
+                return {}
 
-            return tweets[:count]
+            return {
+                'id': ids[:count],
+                'created_at': created_at[:count],
+                'text': text[:count],
+                'likes': likes[:count],
+                'retweets': retweets[:count],
+                'tweet_length': text_lens[:count]
+            }
 
         except Exception as e:
             logger.error(f"Error fetching tweets: {str(e)}")
-            return []
-
-    def transform_tweets(tweets):
-        df = pd.DataFrame(tweets, columns=['id', 'created_at', 'text', 'likes', 'retweets'])
-        if not df.empty:
-            df['id'] = df['id'].astype(str)
-            df['created_at'] = pd.to_datetime(df['created_at'], errors='coerce')
-            df['likes'] = df['likes'].fillna(0).astype(int)
-            df['retweets'] = df['retweets'].fillna(0).astype(int)
-            df['text'] = df['text'].str.replace('\n', ' ').str.strip()
-            df['tweet_length'] = df['text'].str.len()
-            df['created_date'] = df['created_at'].dt.date
-            df['created_hour'] = df['created_at'].dt.hour
-            df = df.sort_values(by='created_at', ascending=False)
-            df = df.reset_index(drop=True)
-        return df
+            return {}
+
+    async def fetch_many(client, handles, count=5, max_concurrency=8):
+        # User IDs never change, so they are cached in Airflow Variables across runs
+        user_ids = {}
+        for handle in handles:
+            cached_id = Variable.get(f"twitter_user_id_{handle}", default_var=None)
+            if cached_id is not None:
+                user_ids[handle.lower()] = int(cached_id)
+
+        # Resolve the rest up front; get_users accepts up to 100 usernames per call
+        unresolved = [handle for handle in handles if handle.lower() not in user_ids]
+        try:
+            for i in range(0, len(unresolved), 100):
+                users = await client.get_users(usernames=unresolved[i:i + 100])
+                for user in users.data or []:
+                    user_ids[user.username.lower()] = user.id
+            for handle in unresolved:
+                if handle.lower() in user_ids:
+                    Variable.set(f"twitter_user_id_{handle}", str(user_ids[handle.lower()]))
+        except tweepy.TweepyException as e:
+            logger.error(f"Failed to resolve users: {str(e)}")
+            return {}
+
+        for handle in handles:
+            if handle.lower() not in user_ids:
+                logger.warning(f"User {handle} not found.")
+        if not user_ids:
+            return {}
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def fetch_one(user_id):
+            async with semaphore:
+                return await get_user_tweets(client, user_id, count)
+
+        results = await asyncio.gather(*(fetch_one(user_id) for user_id in user_ids.values()))
+
+        # Each user's tweets arrive newest-first, so a linear merge keeps the overall order
+        merged = {col: [] for col in _TWEET_COLUMNS}
+        per_user = [zip(*(cols[col] for col in _TWEET_COLUMNS)) for cols in results if cols]
+        for row in heapq.merge(*per_user, key=lambda r: r[1], reverse=True):
+            for col, value in zip(_TWEET_COLUMNS, row):
+                merged[col].append(value)
+
+        return merged if merged['id'] else {}
+
+    def transform_tweets(cols):
+        n = len(cols['id'])
+        if not n:
+            return pd.DataFrame(columns=_CSV_HEADERS)
+
+        if isinstance(cols['created_at'][0], str):
+            created_at = pd.to_datetime(cols['created_at'], format='%Y-%m-%dT%H:%M:%S.%f%z', utc=True, cache=True)
+        else:
+            # tweepy already hands back tz-aware datetimes, no parsing needed
+            created_at = pd.DatetimeIndex(cols['created_at']).tz_convert('UTC')
+
+        # Every column is built with its final dtype, so no casting passes are needed afterwards
+        df = pd.DataFrame({
+            'id': pd.array(cols['id'], dtype='string'),
+            'created_at': created_at,
+            'text': pd.array(cols['text'], dtype='string'),
+            'likes': np.fromiter(cols['likes'], dtype=np.int64, count=n),
+            'retweets': np.fromiter(cols['retweets'], dtype=np.int64, count=n),
+            'tweet_length': np.fromiter(cols['tweet_length'], dtype=np.int64, count=n)
+        })
+        return df.assign(
+            created_date=lambda d: d['created_at'].dt.floor('D'),
+            created_hour=lambda d: d['created_at'].dt.hour
+        )
+
+    def write_csv(cols, buf):
+        # Same output as transform_tweets + _fast_to_csv, without building a DataFrame
+        f = io.TextIOWrapper(buf, encoding='utf-8', newline='')
+        w = csv.writer(f, lineterminator='\n')
+        w.writerow(_CSV_HEADERS)
+        for i in range(len(cols['id'])):
+            created_at = cols['created_at'][i]
+            w.writerow((
+                cols['id'][i],
+                created_at,
+                cols['text'][i],
+                cols['likes'][i] or 0,
+                cols['retweets'][i] or 0,
+                cols['tweet_length'][i],
+                created_at.replace(hour=0, minute=0, second=0, microsecond=0),
+                created_at.hour
+            ))
+        f.flush()
+        f.detach()
+
+    def jsonl_lines(cols):
+        # One orjson-encoded line per tweet; ids stay strings as in the CSV.
+        # Imported here so the default CSV run does not depend on orjson.
+        import orjson
+
+        for row in zip(*(cols[col] for col in _TWEET_COLUMNS)):
+            record = dict(zip(_TWEET_COLUMNS, row))
+            record['id'] = str(record['id'])
+            yield orjson.dumps(record, option=orjson.OPT_NAIVE_UTC) + b'\n'
+
+    async def fetch_tweets(handles, count):
+        client = AsyncClient(
+            bearer_token=BEARER_TOKEN,
+            consumer_key=API_KEY,
+            consumer_secret=API_KEY_SECRET,
+            access_token=ACCESS_TOKEN,
+            access_token_secret=ACCESS_TOKEN_SECRET
+        )
+
+        # AsyncClient only creates its own session when none is set, so this one carries the rate limit hook.
+        # All requests in the run share its connection pool, so pages after the first skip the TLS handshake.
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_end.append(record_rate_limit)
+        client.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=8,
+                limit_per_host=8,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            ),
+            trace_configs=[trace_config]
+        )
+        try:
+            return await fetch_many(client, handles, count=count)
+        finally:
+            await client.session.close()
 
     # Load credentials from Airflow Variables
     try:
@@ -121,38 +345,49 @@ def run_twitter_etl():
         logger.error(f"Failed to load Twitter credentials from Airflow Variables: {str(e)}")
         raise
 
-    client = tweepy.Client(
-        bearer_token=BEARER_TOKEN,
-        consumer_key=API_KEY,
-        consumer_secret=API_KEY_SECRET,
-        access_token=ACCESS_TOKEN,
-        access_token_secret=ACCESS_TOKEN_SECRET
-    )
-
-    logger.info("Checking rate limits before fetching tweets...")
-    remaining_requests = check_rate_limits(client)
-    if remaining_requests < 1:
-        logger.error("No requests remaining in the current rate limit window. Failing task.")
-        raise ValueError("Rate limit exhausted.")
-
     logger.info("Fetching up to 5 tweets for @NASA...")
-    tweets = get_user_tweets(client, "NASA", count=5)
+    tweets = asyncio.run(fetch_tweets(["NASA"], count=5))
 
     if tweets:
-        df = transform_tweets(tweets)
-        logger.info(f"Fetched {len(tweets)} tweets for @NASA")
-        
-        local_path = '/tmp/tweets.csv'
+        num_tweets = len(tweets['id'])
+        logger.info(f"Fetched {num_tweets} tweets for @NASA")
+
+        if output_format == 'jsonl':
+            try:
+                if num_tweets > _PUT_OBJECT_MAX_ROWS:
+                    buf = io.BytesIO()
+                    for line in jsonl_lines(tweets):
+                        buf.write(line)
+                    buf.seek(0)
+                    upload_to_s3(buf, 'airfloe-kini', 'twitter_data/tweets.jsonl', {'ContentType': 'application/x-ndjson'})
+                else:
+                    body = b''.join(jsonl_lines(tweets))
+                    put_to_s3(body, 'airfloe-kini', 'twitter_data/tweets.jsonl', 'application/x-ndjson')
+                logger.info("✅ Tweets serialized to JSONL and uploaded to S3.")
+            except Exception as e:
+                logger.error(f"⚠️ Failed to complete S3 upload: {str(e)}")
+                raise
+            return
+
+        buf = io.BytesIO()
         try:
-            df.to_csv(local_path, index=False)
-            logger.info(f"Local file {local_path} created successfully with {len(df)} rows and columns: {list(df.columns)}")
+            # Buffer ahead of gzip so the many small CSV writes reach the compressor in large chunks
+            with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=3) as gz, \
+                    io.BufferedWriter(gz, buffer_size=_WRITE_BUFFER_SIZE) as out:
+                if num_tweets >= _PANDAS_MIN_ROWS:
+                    df = transform_tweets(tweets)
+                    _fast_to_csv(df, out)
+                else:
+                    write_csv(tweets, out)
+            buf.seek(0)
+            logger.info(f"CSV buffer created successfully with {num_tweets} rows and columns: {_CSV_HEADERS}")
         except Exception as e:
-            logger.error(f"Failed to save CSV locally: {str(e)}")
+            logger.error(f"Failed to write CSV buffer: {str(e)}")
             raise
 
         try:
-            upload_to_s3(local_path, 'airfloe-kini', 'twitter_data/tweets.csv')
-            logger.info("✅ Tweets transformed, saved locally, and uploaded to S3.")
+            upload_to_s3(buf, 'airfloe-kini', 'twitter_data/tweets.csv.gz')
+            logger.info("✅ Tweets transformed and uploaded to S3.")
         except Exception as e:
             logger.error(f"⚠️ Failed to complete S3 upload: {str(e)}")
             raise